@@ -0,0 +1,106 @@
+"""
+Embedding caches.
+
+CachedEmbeddings (ingestion): each chunk is keyed by blake2b(model_name + text),
+so re-running ingest.py only embeds chunks whose text actually changed. Vectors
+are stored as raw float32 bytes in a single SQLite table:
+
+  embeddings(hash BLOB PRIMARY KEY, vec BLOB)
+
+QueryCachedEmbeddings (serving): in-memory LRU over query vectors, so repeat
+questions skip the model forward pass.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from cachetools import LRUCache
+from langchain_core.embeddings import Embeddings
+
+SQLITE_MAX_VARS = 500  # stay well under SQLite's bound-parameter limit
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps another Embeddings model. Documents are looked up in the cache
+    first; only the misses go through the real model, then get written back.
+    Queries are passed straight through.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache_path: str):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(cache_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB NOT NULL)"
+        )
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b((self.model_name + text).encode(), digest_size=16).digest()
+
+    def _lookup(self, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+        found = {}
+        for i in range(0, len(keys), SQLITE_MAX_VARS):
+            batch = keys[i : i + SQLITE_MAX_VARS]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(
+                f"SELECT hash, vec FROM embeddings WHERE hash IN ({placeholders})", batch
+            )
+            for key, vec in rows:
+                found[key] = np.frombuffer(vec, dtype=np.float32)
+        return found
+
+    def find_uncached_texts(self, texts: list[str]) -> tuple[list[bytes], dict[bytes, np.ndarray], list[int]]:
+        """Returns (keys, cached vectors by key, indices of texts that need embedding)."""
+        keys = [self._key(t) for t in texts]
+        cached = self._lookup(list(set(keys)))
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        return keys, cached, missing
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, cached, missing = self.find_uncached_texts(texts)
+
+        if missing:
+            new_vectors = self.embeddings.embed_documents([texts[i] for i in missing])
+            rows = []
+            for i, vec in zip(missing, new_vectors):
+                arr = np.asarray(vec, dtype=np.float32)
+                cached[keys[i]] = arr
+                rows.append((keys[i], arr.tobytes()))
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", rows)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return [cached[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+
+class QueryCachedEmbeddings(Embeddings):
+    """
+    Wraps another Embeddings model with an in-memory LRU on embed_query.
+    Documents are passed straight through.
+    """
+
+    def __init__(self, embeddings: Embeddings, maxsize: int = 4096):
+        self.embeddings = embeddings
+        self.cache: LRUCache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()  # cachetools caches aren't thread-safe
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        with self.lock:
+            vector = self.cache.get(text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            with self.lock:
+                self.cache[text] = vector
+        return vector
@@ -0,0 +1,134 @@
+"""
+Shared embedding model for ingestion (ingest.py) and retrieval (rag.py).
+
+Both sides must embed with the same model and settings, otherwise query
+vectors won't line up with the chunk vectors stored in ChromaDB.
+
+Device selection: CUDA → Apple MPS → CPU. On an accelerator the model runs
+in FP16 through sentence-transformers. On CPU it runs as a dynamically
+quantized int8 ONNX model (exported on first use into EMBEDDING_ONNX_DIR),
+with mean pooling + L2 normalization done in NumPy.
+"""
+
+import os
+import threading
+import numpy as np
+import torch
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_MAX_LENGTH = 256  # all-MiniLM-L6-v2's max_seq_length
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "minilm-onnx")
+ONNX_INT8_FILE = "model.int8.onnx"
+
+# ChromaDB collection settings for these vectors. Embeddings are unit-length,
+# so cosine space reduces to a dot product. HNSW is tuned for a small docs
+# corpus: a denser graph (M, construction_ef) built once at ingest buys recall,
+# and a moderate search_ef keeps query latency low. Applied when ingest.py
+# creates the collection — re-ingest to change them.
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 50,
+    "hnsw:num_threads": os.cpu_count() or 1,
+}
+
+
+def get_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def get_embedding_model_id() -> str:
+    """Model + numeric variant in use, e.g. for keying cached vectors."""
+    device = get_device()
+    if device == "cpu":
+        return f"{EMBEDDING_MODEL}:onnx-int8"
+    return f"{EMBEDDING_MODEL}:{device}-fp16"
+
+
+def get_embeddings(batch_size: int = EMBEDDING_BATCH_SIZE) -> Embeddings:
+    device = get_device()
+    if device == "cpu":
+        return OnnxInt8Embeddings(EMBEDDING_ONNX_DIR, batch_size=batch_size)
+
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={"device": device, "model_kwargs": {"torch_dtype": torch.float16}},
+        encode_kwargs={
+            "batch_size": batch_size,
+            # Unit vectors → cosine similarity is a plain inner product
+            "normalize_embeddings": True,
+            "convert_to_numpy": True,
+        },
+    )
+
+
+# ── CPU path: int8 ONNX Runtime ──────────────────────────────────
+def export_onnx_int8(onnx_dir: str) -> None:
+    """Export EMBEDDING_MODEL to ONNX and write a dynamically int8-quantized copy."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+
+    print(f"[Embeddings] Exporting {EMBEDDING_MODEL} to int8 ONNX in {onnx_dir}/ ...")
+    model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL, export=True)
+    model.save_pretrained(onnx_dir)
+    AutoTokenizer.from_pretrained(EMBEDDING_MODEL).save_pretrained(onnx_dir)
+
+    quantize_dynamic(
+        os.path.join(onnx_dir, "model.onnx"),
+        os.path.join(onnx_dir, ONNX_INT8_FILE),
+        weight_type=QuantType.QInt8,
+    )
+
+
+class OnnxInt8Embeddings(Embeddings):
+    """all-MiniLM-L6-v2 as an int8 ONNX model: tokenize → ORT forward → mean-pool → L2-norm."""
+
+    def __init__(self, onnx_dir: str, batch_size: int = EMBEDDING_BATCH_SIZE):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if not os.path.isfile(os.path.join(onnx_dir, ONNX_INT8_FILE)):
+            export_onnx_int8(onnx_dir)
+
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        # Each fast-tokenizer call re-sets the shared Rust padding/truncation
+        # state, so concurrent callers (query embedding runs in worker threads)
+        # can hit "Already borrowed". The ORT session itself is thread-safe.
+        self.tokenizer_lock = threading.Lock()
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            onnx_dir, file_name=ONNX_INT8_FILE, provider="CPUExecutionProvider"
+        )
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        batches = []
+        for i in range(0, len(texts), self.batch_size):
+            with self.tokenizer_lock:
+                inputs = self.tokenizer(
+                    texts[i : i + self.batch_size],
+                    padding=True,
+                    truncation=True,
+                    max_length=EMBEDDING_MAX_LENGTH,
+                    return_tensors="np",
+                )
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype(np.float32))
+        return np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0].tolist()
@@ -10,10 +10,13 @@ Chunking (Section 5b):
   - 300-500 tokens per chunk (~1200-2000 chars) with 50-token overlap (~200 chars)
   - Split by section headings (H2/H3 boundaries)
   - Preserve metadata: page title, URL, section heading
+  - Drop near-duplicate chunks across sources (MinHash LSH, keep the longer)
 
 Usage:
   python ingest.py --pdf-dir ./documents --llms-txt ./llms.txt
   python ingest.py --pdf-dir ./documents --clear
+  python ingest.py --pdf-dir ./documents --batch-size 512
+  python ingest.py --pdf-dir ./documents --rate-limit-sleep 10   # remote embedding API
 """
 
 import os
@@ -21,59 +24,87 @@ import re
 import argparse
 import time
 import shutil
+import uuid
+import fitz  # PyMuPDF
+from datasketch import MinHash, MinHashLSH
+from concurrent.futures import ProcessPoolExecutor
+from chromadb.utils.batch_utils import create_batches
 from dotenv import load_dotenv
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
+from embeddings import COLLECTION_METADATA, EMBEDDING_BATCH_SIZE, get_embedding_model_id, get_embeddings
+from embedding_cache import CachedEmbeddings
+from keyword_index import CORPUS_FILE, KEYWORD_INDEX_FILE, build_keyword_index, write_corpus
 
 load_dotenv()
 
 # ── Config (Section 5b) ─────────────────────────────────────────
 CHROMA_DIR = os.getenv("CHROMA_DIR", "chroma_db")
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embedding_cache.sqlite3")  # outside CHROMA_DIR so --clear keeps it
 CHUNK_SIZE = 1500           # ~375 tokens (within 300-500 token range)
 CHUNK_OVERLAP = 200         # ~50 tokens
-BATCH_SIZE = 10             # embeddings per API call
-BATCH_DELAY_SECONDS = 10    # rate-limit protection for free-tier APIs
+BATCH_SIZE = EMBEDDING_BATCH_SIZE  # chunks per embedding forward pass
+RATE_LIMIT_SLEEP = 0        # seconds between batches; only needed for remote embedding APIs
+RETRY_DELAY_SECONDS = 20    # backoff before retrying a failed batch
 
-
-def get_embeddings():
-    return HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+# Compiled once — these run inside per-file / per-section loops
+SECTION_SPLIT_RE = re.compile(r"\n(?=## |\n---+\n)")  # H2 headings or horizontal rules
+PATH_RE = re.compile(r"^/[a-z]")                        # lines that look like site paths
+PUNCT_RE = re.compile(r"[-_]")
 
 
 # ── 1. PDF Loader (Section 5a-2) ────────────────────────────────
+def _load_one_pdf(filepath: str) -> list[Document]:
+    """Load a single PDF and tag its pages. Top-level so worker processes can pickle it."""
+    filename = os.path.basename(filepath)
+    with fitz.open(filepath) as pdf:
+        pages = [
+            Document(page_content=page.get_text("text"), metadata={"source": filepath, "page": i})
+            for i, page in enumerate(pdf)
+        ]
+
+    # Derive title from filename
+    title = PUNCT_RE.sub(" ", filename.replace(".pdf", "")).strip().title()
+
+    # Derive a product URL slug
+    slug = filename.replace(".pdf", "").lower().replace(" ", "-").replace("_", "-")
+    url = f"/products/{slug}.html"
+
+    for page in pages:
+        page.metadata["title"] = title
+        page.metadata["url"] = url
+        page.metadata["source_type"] = "pdf"
+
+    return pages
+
+
 def load_pdfs(pdf_dir: str) -> list[Document]:
     docs = []
     if not os.path.isdir(pdf_dir):
         print(f"  [SKIP] PDF directory not found: {pdf_dir}")
         return docs
 
-    pdf_files = sorted(f for f in os.listdir(pdf_dir) if f.lower().endswith(".pdf"))
+    # DirEntry caches the file type, so is_file() needs no extra stat call
+    with os.scandir(pdf_dir) as entries:
+        pdf_files = sorted(
+            e.name for e in entries if e.is_file() and e.name.lower().endswith(".pdf")
+        )
     print(f"  Found {len(pdf_files)} PDF files")
 
-    for filename in pdf_files:
-        filepath = os.path.join(pdf_dir, filename)
-        try:
-            loader = PyPDFLoader(filepath)
-            pages = loader.load()
-
-            # Derive title from filename
-            title = re.sub(r"[-_]", " ", filename.replace(".pdf", "")).strip().title()
-
-            # Derive a product URL slug
-            slug = filename.replace(".pdf", "").lower().replace(" ", "-").replace("_", "-")
-            url = f"/products/{slug}.html"
-
-            for page in pages:
-                page.metadata["title"] = title
-                page.metadata["url"] = url
-                page.metadata["source_type"] = "pdf"
-
-            docs.extend(pages)
-            print(f"    OK: {filename} ({len(pages)} pages)")
-        except Exception as e:
-            print(f"    ERROR: {filename} — {e}")
+    # PDF parsing is CPU-bound — fan out across cores, collect in filename order
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            (filename, executor.submit(_load_one_pdf, os.path.join(pdf_dir, filename)))
+            for filename in pdf_files
+        ]
+        for filename, future in futures:
+            try:
+                pages = future.result()
+                docs.extend(pages)
+                print(f"    OK: {filename} ({len(pages)} pages)")
+            except Exception as e:
+                print(f"    ERROR: {filename} — {e}")
 
     return docs
 
@@ -89,7 +120,7 @@ def load_llms_txt(filepath: str) -> list[Document]:
         content = f.read()
 
     # Split by markdown H2/H3 headings or horizontal rules
-    sections = re.split(r"\n(?=## |\n---+\n)", content)
+    sections = SECTION_SPLIT_RE.split(content)
 
     for section in sections:
         section = section.strip()
@@ -107,7 +138,7 @@ def load_llms_txt(filepath: str) -> list[Document]:
                 url = line_stripped.split(":", 1)[1].strip()
                 break
             # Match lines that look like paths: /something
-            if re.match(r"^/[a-z]", line_stripped):
+            if PATH_RE.match(line_stripped):
                 url = line_stripped
                 break
 
@@ -192,58 +223,206 @@ Mage Data's platform provides automated data discovery, classification, masking,
 
 
 # ── Chunking (Section 5b) ───────────────────────────────────────
+# llms.txt sections and manual entries are Markdown: split on their H2/H3
+# headings directly (heading text lands in metadata), and only fall back to
+# the character splitter for sections that are still too long. Sections are
+# sliced from the original text, so paragraph breaks and list indentation
+# survive. PDFs have no Markdown headings, so they go straight to the
+# character splitter.
+STRUCTURED_SOURCE_TYPES = {"sitemap", "manual"}
+
+HEADING_RE = re.compile(r"^(#{2,3})\s+(.+?)\s*$")  # "## Title" → h2, "### Title" → h3
+FENCE_PREFIXES = ("```", "~~~")
+
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    separators=["\n\n", "\n", ". ", " ", ""],
+    length_function=len,
+)
+
+
+def _heading_sections(text: str) -> list[tuple[str, dict]]:
+    """Slice text at H2/H3 lines (outside code fences) → [(section, {"h2": .., "h3": ..})]."""
+    sections = []
+    headings: dict[str, str] = {}
+    section_start = 0
+    section_meta: dict[str, str] = {}
+    in_fence = False
+
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith(FENCE_PREFIXES):
+            in_fence = not in_fence
+        elif not in_fence and (match := HEADING_RE.match(stripped)):
+            sections.append((text[section_start:offset], section_meta))
+            if match.group(1) == "##":
+                headings = {"h2": match.group(2)}
+            else:
+                headings = {k: v for k, v in headings.items() if k == "h2"}
+                headings["h3"] = match.group(2)
+            section_start = offset
+            section_meta = dict(headings)
+        offset += len(line)
+    sections.append((text[section_start:], section_meta))
+
+    return [(section.strip(), meta) for section, meta in sections if section.strip()]
+
+
+def _split_by_headings(doc: Document) -> list[Document]:
+    chunks = []
+    for section, headings in _heading_sections(doc.page_content):
+        section_doc = Document(page_content=section, metadata={**doc.metadata, **headings})
+        if len(section_doc.page_content) <= CHUNK_SIZE:
+            chunks.append(section_doc)
+        else:
+            chunks.extend(TEXT_SPLITTER.split_documents([section_doc]))
+    return chunks
+
+
 def chunk_documents(docs: list[Document]) -> list[Document]:
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        separators=["\n## ", "\n### ", "\n\n", "\n", ". ", " ", ""],
-        length_function=len,
-    )
-    chunks = splitter.split_documents(docs)
+    chunks = []
+    for doc in docs:
+        if doc.metadata.get("source_type") in STRUCTURED_SOURCE_TYPES:
+            chunks.extend(_split_by_headings(doc))
+        else:
+            chunks.extend(TEXT_SPLITTER.split_documents([doc]))
     print(f"  Split {len(docs)} documents into {len(chunks)} chunks")
     return chunks
 
 
-# ── Ingest into ChromaDB with rate-limit batching ────────────────
-def ingest_to_chroma(chunks: list[Document], clear: bool = True):
-    embeddings = get_embeddings()
+# ── Near-duplicate removal ───────────────────────────────────────
+# The same blurb (pricing, contact, deployment) shows up in manual entries,
+# llms.txt and PDFs. Duplicates cost embeddings and storage, skew BM25 IDF and
+# crowd the top-k, so drop chunks whose 5-word shingles are ~90% identical to
+# one already kept (MinHash LSH), keeping the longer of the two.
+DEDUP_THRESHOLD = 0.9
+DEDUP_NUM_PERM = 64
+SHINGLE_SIZE = 5
+
+
+def _minhash(text: str) -> MinHash:
+    words = text.lower().split()
+    shingles = {
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+    }
+    mh = MinHash(num_perm=DEDUP_NUM_PERM)
+    mh.update_batch([s.encode("utf-8") for s in shingles])
+    return mh
+
+
+def dedupe_chunks(chunks: list[Document]) -> list[Document]:
+    lsh = MinHashLSH(threshold=DEDUP_THRESHOLD, num_perm=DEDUP_NUM_PERM)
+    kept: dict[str, Document] = {}
+    signatures: dict[str, MinHash] = {}
+
+    for i, chunk in enumerate(chunks):
+        key = str(i)
+        mh = _minhash(chunk.page_content)
+
+        # LSH candidates are approximate — confirm with the estimated Jaccard
+        duplicates = [
+            candidate
+            for candidate in lsh.query(mh)
+            if mh.jaccard(signatures[candidate]) >= DEDUP_THRESHOLD
+        ]
+        if any(len(kept[d].page_content) >= len(chunk.page_content) for d in duplicates):
+            continue
+        for duplicate in duplicates:
+            lsh.remove(duplicate)
+            del kept[duplicate]
+            del signatures[duplicate]
+
+        lsh.insert(key, mh)
+        kept[key] = chunk
+        signatures[key] = mh
+
+    removed = len(chunks) - len(kept)
+    pct = 100 * removed / len(chunks) if chunks else 0
+    print(f"  Removed {removed} near-duplicate chunks ({pct:.1f}%), {len(kept)} remain")
+    return list(kept.values())
+
+
+# ── Ingest into ChromaDB (bulk embed → single add) ───────────────
+def ingest_to_chroma(
+    chunks: list[Document],
+    clear: bool = True,
+    batch_size: int = BATCH_SIZE,
+    rate_limit_sleep: float = RATE_LIMIT_SLEEP,
+):
+    embeddings = CachedEmbeddings(get_embeddings(batch_size), get_embedding_model_id(), EMBED_CACHE_PATH)
 
     if clear and os.path.isdir(CHROMA_DIR):
         shutil.rmtree(CHROMA_DIR)
         print(f"  Cleared existing ChromaDB at ./{CHROMA_DIR}/")
 
-    total_batches = (len(chunks) + BATCH_SIZE - 1) // BATCH_SIZE
-    print(f"  Ingesting {len(chunks)} chunks in {total_batches} batches...")
+    total_batches = (len(chunks) + batch_size - 1) // batch_size
+    print(f"  Embedding {len(chunks)} chunks in {total_batches} batches...")
 
-    db = None
-    for i in range(0, len(chunks), BATCH_SIZE):
-        batch = chunks[i : i + BATCH_SIZE]
-        batch_num = (i // BATCH_SIZE) + 1
+    # Embed up front so Chroma doesn't re-run the model on every add call
+    kept: list[Document] = []
+    vectors: list[list[float]] = []
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i : i + batch_size]
+        batch_num = (i // batch_size) + 1
+        texts = [c.page_content for c in batch]
 
         try:
-            if db is None:
-                db = Chroma.from_documents(batch, embeddings, persist_directory=CHROMA_DIR)
-            else:
-                db.add_documents(batch)
-
+            batch_vectors = embeddings.embed_documents(texts)
             print(f"    Batch {batch_num}/{total_batches} — {len(batch)} chunks ✓")
         except Exception as e:
             print(f"    Batch {batch_num}/{total_batches} — ERROR: {e}")
-            print(f"    Waiting {BATCH_DELAY_SECONDS * 2}s before retrying...")
-            time.sleep(BATCH_DELAY_SECONDS * 2)
+            print(f"    Waiting {RETRY_DELAY_SECONDS}s before retrying...")
+            time.sleep(RETRY_DELAY_SECONDS)
             try:
-                if db is None:
-                    db = Chroma.from_documents(batch, embeddings, persist_directory=CHROMA_DIR)
-                else:
-                    db.add_documents(batch)
+                batch_vectors = embeddings.embed_documents(texts)
                 print(f"    Batch {batch_num}/{total_batches} — retry ✓")
             except Exception as e2:
                 print(f"    Batch {batch_num}/{total_batches} — FAILED: {e2}")
+                continue
+
+        kept.extend(batch)
+        vectors.extend(batch_vectors)
 
-        if i + BATCH_SIZE < len(chunks):
-            time.sleep(BATCH_DELAY_SECONDS)
+        if rate_limit_sleep and i + batch_size < len(chunks):
+            time.sleep(rate_limit_sleep)
 
-    print(f"\n  Done! {len(chunks)} chunks stored in ./{CHROMA_DIR}/")
+    print(f"  Embedding cache: {embeddings.hits} hits, {embeddings.misses} computed")
+
+    db = Chroma(
+        persist_directory=CHROMA_DIR,
+        embedding_function=embeddings,
+        collection_metadata=COLLECTION_METADATA,
+    )
+    if not kept:
+        print("\n  ⚠ No chunks were embedded — nothing stored.")
+        return db
+
+    # Write precomputed vectors straight to the collection. create_batches only
+    # splits when we exceed Chroma's max batch size; normally this is one add.
+    ids = [str(uuid.uuid4()) for _ in kept]
+    for batch_ids, batch_vectors, batch_metas, batch_texts in create_batches(
+        api=db._client,
+        ids=ids,
+        embeddings=vectors,
+        metadatas=[c.metadata for c in kept],
+        documents=[c.page_content for c in kept],
+    ):
+        db._collection.add(
+            ids=batch_ids,
+            embeddings=batch_vectors,
+            metadatas=batch_metas,
+            documents=batch_texts,
+        )
+
+    # Keyword (BM25) index for the ensemble retriever, so the server doesn't rebuild it,
+    # plus a JSONL copy of the chunks to rebuild it from without reading ChromaDB back
+    build_keyword_index(os.path.join(CHROMA_DIR, KEYWORD_INDEX_FILE), kept)
+    write_corpus(os.path.join(CHROMA_DIR, CORPUS_FILE), kept)
+
+    print(f"\n  Done! {len(kept)} chunks stored in ./{CHROMA_DIR}/")
     return db
 
 
@@ -253,6 +432,11 @@ def main():
     parser.add_argument("--pdf-dir", default="./documents", help="Directory containing PDF files")
     parser.add_argument("--llms-txt", default="./llms.txt", help="Path to llms.txt sitemap file")
     parser.add_argument("--clear", action="store_true", default=True, help="Clear existing DB before ingestion")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Chunks per embedding batch")
+    parser.add_argument(
+        "--rate-limit-sleep", type=float, default=RATE_LIMIT_SLEEP,
+        help="Seconds to sleep between batches (for rate-limited remote embedding APIs)",
+    )
     args = parser.parse_args()
 
     print("=" * 60)
@@ -277,8 +461,13 @@ def main():
         return
 
     print("\n[4/4] Chunking & ingesting...")
-    chunks = chunk_documents(all_docs)
-    ingest_to_chroma(chunks, clear=args.clear)
+    chunks = dedupe_chunks(chunk_documents(all_docs))
+    ingest_to_chroma(
+        chunks,
+        clear=args.clear,
+        batch_size=args.batch_size,
+        rate_limit_sleep=args.rate_limit_sleep,
+    )
 
     print("\n" + "=" * 60)
     print("  ✓ Ingestion complete!")
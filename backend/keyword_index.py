@@ -0,0 +1,92 @@
+"""
+Keyword (BM25) retrieval backed by SQLite FTS5.
+
+The index is a standalone SQLite file inside CHROMA_DIR, written by ingest.py
+and reopened by rag.py. Tokenizing, posting lists and BM25 ranking all run in
+SQLite's C code instead of Python loops, and nothing has to be rebuilt or
+held in Python memory when the server starts.
+"""
+
+import os
+import re
+import sqlite3
+from contextlib import closing
+import orjson
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+KEYWORD_INDEX_FILE = "keyword_index.sqlite3"
+CORPUS_FILE = "corpus.jsonl"  # one {"t": text, "m": metadata} per chunk
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def build_keyword_index(path: str, docs: list[Document]) -> None:
+    """Write a fresh FTS5 index for docs. Built beside the target, then swapped in."""
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    with closing(sqlite3.connect(tmp_path)) as conn, conn:
+        conn.execute(
+            "CREATE VIRTUAL TABLE chunks USING fts5("
+            "title, content, metadata UNINDEXED, tokenize='porter unicode61')"
+        )
+        conn.executemany(
+            "INSERT INTO chunks (title, content, metadata) VALUES (?, ?, ?)",
+            (
+                (d.metadata.get("title", ""), d.page_content, orjson.dumps(d.metadata).decode())
+                for d in docs
+            ),
+        )
+        # Bulk inserts leave many small b-tree segments. Merge them so each
+        # term's posting list (doc ids + term frequencies) is one contiguous
+        # run — a compact CSR-style layout that bm25() scans without hopping.
+        conn.execute("INSERT INTO chunks(chunks) VALUES ('optimize')")
+
+    os.replace(tmp_path, path)
+
+
+def write_corpus(path: str, docs: list[Document]) -> None:
+    """Sidecar copy of the chunks, so the index can be rebuilt without querying ChromaDB."""
+    with open(path, "wb") as f:
+        f.writelines(orjson.dumps({"t": d.page_content, "m": d.metadata}) + b"\n" for d in docs)
+
+
+def read_corpus(path: str) -> list[Document]:
+    with open(path, "rb") as f:
+        return [
+            Document(page_content=row["t"], metadata=row["m"])
+            for row in map(orjson.loads, f)
+        ]
+
+
+def count_indexed(path: str) -> int:
+    with closing(sqlite3.connect(path)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+class FTS5Retriever(BaseRetriever):
+    """Top-k chunks by FTS5 bm25() rank over the title and content columns."""
+
+    index_path: str
+    k: int = 5
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        # Quote every term so user punctuation can't be parsed as FTS5 syntax
+        terms = dict.fromkeys(TOKEN_RE.findall(query.lower()))
+        if not terms:
+            return []
+        match = " OR ".join(f'"{t}"' for t in terms)
+
+        # One short-lived connection per call keeps this safe across threads
+        with closing(sqlite3.connect(self.index_path)) as conn:
+            rows = conn.execute(
+                "SELECT content, metadata FROM chunks WHERE chunks MATCH ? ORDER BY rank LIMIT ?",
+                (match, self.k),
+            ).fetchall()
+
+        return [Document(page_content=content, metadata=orjson.loads(meta)) for content, meta in rows]
@@ -1,28 +1,43 @@
 """
 Mage Data Chatbot — FastAPI Backend
 Endpoints:
-  POST /api/chat   — RAG chat completion
+  POST /api/chat   — RAG chat completion (JSON, or SSE with Accept: text/event-stream)
   POST /api/lead   — Lead capture → HubSpot webhook + local log
   GET  /api/health  — Health check
 """
 
+import json
 import os
 import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 import httpx
 from rag import RAGPipeline
 
+# ── Shared HTTP client (keep-alive / HTTP/2 pooling for HubSpot) ─
+HTTP_CLIENT = httpx.AsyncClient(
+    timeout=10,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await HTTP_CLIENT.aclose()
+
 # ── App ──────────────────────────────────────────────────────────
-app = FastAPI(title="Mage Data Chatbot API", version="1.0.0")
+app = FastAPI(title="Mage Data Chatbot API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=os.getenv("ALLOWED_ORIGINS", "*").split(","),
     allow_methods=["POST", "GET", "OPTIONS"],
-    allow_headers=["Content-Type"],
+    allow_headers=["Content-Type", "Accept"],
 )
 
 # ── RAG singleton (loaded once at startup) ───────────────────────
@@ -58,10 +73,17 @@ class LeadResponse(BaseModel):
 
 
 # ── POST /api/chat ───────────────────────────────────────────────
+CHAT_ERROR_REPLY = "Sorry, I'm having trouble connecting right now. Please try again or contact info@magedata.ai"
+
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request):
     """
     Receives conversation messages, runs RAG pipeline, returns response + sources.
+
+    Clients that send `Accept: text/event-stream` get the reply streamed as SSE:
+      data: {"delta": "..."}     — repeated as the LLM generates
+      data: {"sources": [...]}   — once, after the reply
+      data: {"error": "..."}     — instead of the above if the pipeline fails
     """
     if not req.messages:
         raise HTTPException(400, "No messages provided")
@@ -69,6 +91,13 @@ async def chat(req: ChatRequest):
     user_message = req.messages[-1].content
     history = [{"role": m.role, "content": m.content} for m in req.messages[:-1]]
 
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _chat_events(user_message, history),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     try:
         result = await rag.query(user_message, history)
         return ChatResponse(
@@ -77,10 +106,16 @@ async def chat(req: ChatRequest):
         )
     except Exception as e:
         print(f"[{datetime.now().isoformat()}] RAG error: {e}")
-        return ChatResponse(
-            reply="Sorry, I'm having trouble connecting right now. Please try again or contact info@magedata.ai",
-            sources=[],
-        )
+        return ChatResponse(reply=CHAT_ERROR_REPLY, sources=[])
+
+
+async def _chat_events(user_message: str, history: list[dict]):
+    try:
+        async for event in rag.stream(user_message, history):
+            yield f"data: {json.dumps(event)}\n\n"
+    except Exception as e:
+        print(f"[{datetime.now().isoformat()}] RAG error: {e}")
+        yield f"data: {json.dumps({'error': CHAT_ERROR_REPLY})}\n\n"
 
 
 # ── POST /api/lead (Section 7) ──────────────────────────────────
@@ -117,12 +152,11 @@ async def capture_lead(req: LeadRequest):
             },
         }
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(url, json=payload, timeout=10)
-                if resp.status_code in (200, 201):
-                    return LeadResponse(success=True, message="Thank you! We'll be in touch.")
-                else:
-                    print(f"[HUBSPOT] Error {resp.status_code}: {resp.text}")
+            resp = await HTTP_CLIENT.post(url, json=payload)
+            if resp.status_code in (200, 201):
+                return LeadResponse(success=True, message="Thank you! We'll be in touch.")
+            else:
+                print(f"[HUBSPOT] Error {resp.status_code}: {resp.text}")
         except Exception as e:
             print(f"[HUBSPOT] Webhook failed: {e}")
 
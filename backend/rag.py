@@ -1,6 +1,6 @@
 """
 RAG Pipeline for Mage Data Chatbot.
-Vector search (Chroma + BM25 ensemble) → Prompt construction → LLM call → Response.
+Vector search (Chroma + SQLite FTS5 BM25 ensemble) → Prompt construction → LLM call → Response.
 
 Uses the EXACT system prompt from Section 4c of the build instructions.
 api_key=SecretStr(os.getenv("OPENROUTER_API_KEY", "")),
@@ -8,19 +8,60 @@ from pydantic import SecretStr
 f the build instructions.
 """
 
+import asyncio
+import hashlib
+import io
 import os
 import re
+from collections.abc import AsyncIterator
+import tiktoken
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from pydantic import SecretStr
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai import ChatOpenAI
 from langchain_chroma import Chroma
-from langchain_classic.retrievers import EnsembleRetriever
-from langchain_community.retrievers import BM25Retriever
 from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from embeddings import COLLECTION_METADATA, get_embeddings
+from embedding_cache import QueryCachedEmbeddings
+from keyword_index import (
+    CORPUS_FILE,
+    KEYWORD_INDEX_FILE,
+    FTS5Retriever,
+    build_keyword_index,
+    count_indexed,
+    read_corpus,
+)
 
 load_dotenv()
 
+RETRIEVAL_CACHE_SIZE = 1024
+RETRIEVAL_CACHE_TTL = 300  # seconds
+
+RETRIEVER_WEIGHTS = (0.6, 0.4)  # semantic, keyword
+RRF_K = 60                      # rank-fusion damping constant
+
+# Filename → title/slug helpers for _extract_sources
+EXT_RE = re.compile(r"\.(pdf|html|md|txt)$", re.I)
+PUNCT_RE = re.compile(r"[-_]")
+
+NO_CONTEXT_REPLY = "I don't have that information. Please contact info@magedata.ai"
+
+
+def reciprocal_rank_fusion(
+    result_lists: list[list[Document]], weights: tuple[float, ...]
+) -> list[Document]:
+    """Weighted Reciprocal Rank Fusion, deduplicating chunks by their text."""
+    scores: dict[str, float] = {}
+    by_content: dict[str, Document] = {}
+    for docs, weight in zip(result_lists, weights):
+        for rank, doc in enumerate(docs, start=1):
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + weight / (rank + RRF_K)
+            by_content.setdefault(key, doc)
+    return [by_content[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
 # ── System prompt ────────────────────────────────────────────────
 SYSTEM_PROMPT = """You are Mage Data's virtual assistant on magedata.ai. RULES:
 
@@ -41,23 +82,52 @@ HANDLING IN-SCOPE BUT UNDOCUMENTED QUESTIONS:
 If the user greets you or makes small talk, respond warmly and briefly, then guide them to ask about Mage Data's products and capabilities."""
 
 
+# ── Prompt token budget ──────────────────────────────────────────
+# cl100k_base is an approximation of the served model's tokenizer — close
+# enough to keep the prompt (and LLM latency) bounded.
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "3000"))
+TOKENIZER = tiktoken.get_encoding("cl100k_base")
+MIN_TOP_CHUNK_TOKENS = 256  # the top chunk always gets at least this much room
+
+
+def _count_tokens(text: str) -> int:
+    # encode_ordinary treats "<|endoftext|>" etc. as plain text — user input
+    # and ingested docs can contain them, and encode() would raise
+    return len(TOKENIZER.encode_ordinary(text))
+
+
+SYSTEM_PROMPT_TOKENS = _count_tokens(SYSTEM_PROMPT)
+
+
+def _source_label(doc: Document) -> str:
+    return doc.metadata.get("title") or doc.metadata.get("source") or "Unknown"
+
+
 class RAGPipeline:
     """
     Self-contained RAG pipeline. Initializes once at server startup.
     """
 
     def __init__(self):
+        self.chroma_dir = os.getenv("CHROMA_DIR", "chroma_db")
         self.db = self._init_vectorstore()
         self.llm = self._init_llm()
-        self.retriever = self._init_retriever()
+        self.semantic, self.keyword = self._init_retrievers()
+
+        # Retrieval results by normalized query. Keyed per index version, so a
+        # re-ingest (which rewrites chroma.sqlite3) drops everything cached.
+        # Only touched from the event loop, so no lock is needed.
+        self._retrieval_cache: TTLCache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+        self._cache_version = self._index_version()
 
     # ── Vector store ─────────────────────────────────────────────
     def _init_vectorstore(self) -> Chroma:
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
+        embeddings = QueryCachedEmbeddings(get_embeddings())
+        return Chroma(
+            persist_directory=self.chroma_dir,
+            embedding_function=embeddings,
+            collection_metadata=COLLECTION_METADATA,
         )
-        chroma_dir = os.getenv("CHROMA_DIR", "chroma_db")
-        return Chroma(persist_directory=chroma_dir, embedding_function=embeddings)
 
     # ── LLM (OpenRouter free tier) ───────────────────────────────
     def _init_llm(self) -> ChatOpenAI:
@@ -70,31 +140,99 @@ class RAGPipeline:
             timeout=30,
         )
 
-    # ── Ensemble retriever (Section 4b — semantic + keyword) ─────
-    def _init_retriever(self):
+    # ── Ensemble retrievers (Section 4b — semantic + keyword) ────
+    def _init_retrievers(self) -> tuple[BaseRetriever, FTS5Retriever | None]:
         semantic = self.db.as_retriever(
             search_type="similarity",
             search_kwargs={"k": 5},
         )
 
-        # Build BM25 index from all stored chunks
-        all_data = self.db.get(include=["documents", "metadatas"])
-        if not all_data["documents"]:
+        keyword = self._init_keyword_retriever()
+        if keyword is None:
             print("[RAG] Warning: ChromaDB is empty. Using semantic-only retriever.")
-            return semantic
 
-        docs = [
+        return semantic, keyword
+
+    # ── Keyword index (SQLite FTS5 file next to ChromaDB) ────────
+    def _init_keyword_retriever(self) -> FTS5Retriever | None:
+        """
+        Reuse the FTS5 index written by ingest.py unless ChromaDB has changed
+        since; otherwise rebuild it from the stored chunks.
+        """
+        index_path = os.path.join(self.chroma_dir, KEYWORD_INDEX_FILE)
+        chroma_path = os.path.join(self.chroma_dir, "chroma.sqlite3")
+        total = self.db._collection.count()
+        if not total:
+            return None
+
+        try:
+            fresh = (
+                os.path.exists(index_path)
+                and os.path.getmtime(index_path) >= os.path.getmtime(chroma_path)
+                and count_indexed(index_path) == total
+            )
+        except Exception as e:
+            print(f"[RAG] Warning: could not read {index_path} ({e}), rebuilding.")
+            fresh = False
+
+        if not fresh:
+            build_keyword_index(index_path, self._load_corpus(total))
+            print(f"[RAG] Built keyword index at {index_path}")
+
+        print(f"[RAG] Ensemble retriever initialized with {total} chunks.")
+        return FTS5Retriever(index_path=index_path, k=5)
+
+    def _load_corpus(self, total: int) -> list[Document]:
+        """All stored chunks — from ingest.py's JSONL sidecar if it's current, else ChromaDB."""
+        corpus_path = os.path.join(self.chroma_dir, CORPUS_FILE)
+        chroma_path = os.path.join(self.chroma_dir, "chroma.sqlite3")
+        try:
+            if os.path.getmtime(corpus_path) >= os.path.getmtime(chroma_path):
+                docs = read_corpus(corpus_path)
+                if len(docs) == total:
+                    return docs
+        except (OSError, ValueError, KeyError):
+            pass
+
+        all_data = self.db.get(include=["documents", "metadatas"])
+        return [
             Document(page_content=text, metadata=meta)
             for text, meta in zip(all_data["documents"], all_data["metadatas"])
         ]
-        bm25 = BM25Retriever.from_documents(docs)
-        bm25.k = 5
 
-        print(f"[RAG] Ensemble retriever initialized with {len(docs)} chunks.")
-        return EnsembleRetriever(
-            retrievers=[semantic, bm25],
-            weights=[0.6, 0.4],
+    # ── Retrieval cache ──────────────────────────────────────────
+    def _index_version(self) -> int:
+        try:
+            return os.stat(os.path.join(self.chroma_dir, "chroma.sqlite3")).st_mtime_ns
+        except OSError:
+            return 0
+
+    async def _aretrieve(self, query: str) -> list[Document]:
+        """Ensemble retrieval, served from the TTL cache for repeat questions."""
+        normalized = " ".join(query.lower().split())
+        key = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+        version = self._index_version()
+
+        if version != self._cache_version:
+            self._retrieval_cache.clear()
+            self._cache_version = version
+
+        docs = self._retrieval_cache.get(key)
+        if docs is None:
+            docs = await self._ensemble_search(query)
+            self._retrieval_cache[key] = docs
+        return docs
+
+    async def _ensemble_search(self, query: str) -> list[Document]:
+        """Run semantic and keyword search concurrently, then fuse the rankings."""
+        if self.keyword is None:
+            return await asyncio.to_thread(self.semantic.invoke, query)
+
+        semantic_docs, keyword_docs = await asyncio.gather(
+            asyncio.to_thread(self.semantic.invoke, query),
+            asyncio.to_thread(self.keyword.invoke, query),
         )
+        return reciprocal_rank_fusion([semantic_docs, keyword_docs], RETRIEVER_WEIGHTS)
 
     # ── Extract source links from retrieved docs ─────────────────
     def _extract_sources(self, docs: list[Document]) -> list[dict]:
@@ -108,15 +246,13 @@ class RAGPipeline:
 
             # Derive title from filename if missing
             if not title and source_file:
-                title = os.path.basename(source_file)
-                title = re.sub(r"[-_]", " ", title)
-                title = re.sub(r"\.(pdf|html|md|txt)$", "", title, flags=re.I)
+                title = EXT_RE.sub("", PUNCT_RE.sub(" ", os.path.basename(source_file)))
                 title = title.strip().title()
 
             # Derive URL from source path if missing
             if not url and source_file:
                 basename = os.path.basename(source_file)
-                name = re.sub(r"\.(pdf|html|md|txt)$", "", basename, flags=re.I)
+                name = EXT_RE.sub("", basename)
                 slug = name.lower().replace(" ", "-").replace("_", "-")
                 url = f"/products/{slug}.html"
 
@@ -129,13 +265,36 @@ class RAGPipeline:
 
     # ── Build the LLM message list ───────────────────────────────
     def _build_messages(
-        self, query: str, context: str, history: list[dict]
-    ) -> list[dict]:
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-
-        # Last 6 turns of history
-        for msg in history[-6:]:
-            messages.append({"role": msg["role"], "content": msg["content"]})
+        self, query: str, docs: list[Document], history: list[dict]
+    ) -> tuple[list[dict], list[Document]]:
+        """
+        Returns the message list plus the chunks that made it into the prompt.
+        Everything shares MAX_CONTEXT_TOKENS, filled in priority order:
+          1. system prompt + question
+          2. the top-ranked chunk (truncated if it doesn't fit on its own)
+          3. history turns, newest first — older turns are dropped
+          4. remaining chunks in rank order, until the next one doesn't fit
+        """
+        remaining = MAX_CONTEXT_TOKENS - SYSTEM_PROMPT_TOKENS - _count_tokens(query)
+
+        packed = []
+        if docs:
+            top, cost = self._fit_doc(docs[0], max(remaining, MIN_TOP_CHUNK_TOKENS))
+            packed.append(top)
+            remaining -= cost
+
+        # Last 6 turns of history, trimmed oldest-first to the budget
+        turns = []
+        for msg in reversed(history[-6:]):
+            cost = _count_tokens(msg["content"])
+            if cost > remaining:
+                break
+            turns.append({"role": msg["role"], "content": msg["content"]})
+            remaining -= cost
+        turns.reverse()
+
+        packed.extend(self._pack_docs(docs[1:], remaining))
+        context = self._build_context(packed)
 
         # User message with retrieved context
         user_prompt = f"""Context from Mage Data documentation:
@@ -145,41 +304,96 @@ class RAGPipeline:
 
 User question: {query}"""
 
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}, *turns]
         messages.append({"role": "user", "content": user_prompt})
-        return messages
+        return messages, packed
+
+    def _fit_doc(self, doc: Document, budget: int) -> tuple[Document, int]:
+        """The doc (or a copy cut to budget tokens) and its token cost."""
+        label_cost = _count_tokens(_source_label(doc))
+        tokens = TOKENIZER.encode_ordinary(doc.page_content)
+        if label_cost + len(tokens) <= budget:
+            return doc, label_cost + len(tokens)
+
+        keep = max(budget - label_cost, 0)
+        truncated = Document(page_content=TOKENIZER.decode(tokens[:keep]), metadata=doc.metadata)
+        return truncated, label_cost + keep
+
+    def _pack_docs(self, docs: list[Document], remaining: int) -> list[Document]:
+        packed = []
+        for doc in docs:
+            cost = _count_tokens(_source_label(doc)) + _count_tokens(doc.page_content)
+            if cost > remaining:
+                break
+            packed.append(doc)
+            remaining -= cost
+        return packed
+
+    # ── Context block for the prompt ─────────────────────────────
+    def _build_context(self, docs: list[Document]) -> str:
+        # Written straight into one buffer — no per-chunk f-strings or list
+        titles = [_source_label(d) for d in docs]
+        buf = io.StringIO()
+        write = buf.write
+        for i, (title, doc) in enumerate(zip(titles, docs)):
+            if i:
+                write("\n\n")
+            write("[Source: ")
+            write(title)
+            write("]\n")
+            write(doc.page_content)
+        return buf.getvalue()
 
     # ── Main query method ────────────────────────────────────────
     async def query(self, user_message: str, history: list[dict] | None = None) -> dict:
         """
         Full RAG pipeline:
           1. Retrieve relevant chunks (ensemble: semantic + BM25)
-          2. Build prompt with context + conversation history
+          2. Build prompt with as much context as fits the token budget
           3. Call LLM
           4. Return reply + source links
         """
         history = history or []
 
         # 1. Retrieve
-        docs = self.retriever.invoke(user_message)
+        docs = await self._aretrieve(user_message)
 
-        # 2. Build context
-        context = "\n\n".join([
-            f"[Source: {d.metadata.get('title', d.metadata.get('source', 'Unknown'))}]\n{d.page_content}"
-            for d in docs
-        ])
+        if not docs:
+            return {"reply": NO_CONTEXT_REPLY, "sources": []}
 
-        if not context.strip():
-            return {
-                "reply": "I don't have that information. Please contact info@magedata.ai",
-                "sources": [],
-            }
+        # 2. Build prompt (context packed to MAX_CONTEXT_TOKENS)
+        messages, used_docs = self._build_messages(user_message, docs, history)
 
         # 3. Call LLM
-        messages = self._build_messages(user_message, context, history)
-        response = self.llm.invoke(messages)
+        response = await self.llm.ainvoke(messages)
         reply = response.content
 
         # 4. Extract sources
-        sources = self._extract_sources(docs)
+        sources = self._extract_sources(used_docs)
 
         return {"reply": reply, "sources": sources}
+
+    # ── Streaming query method ───────────────────────────────────
+    async def stream(
+        self, user_message: str, history: list[dict] | None = None
+    ) -> AsyncIterator[dict]:
+        """
+        Same pipeline as query(), but yields events as the LLM generates:
+          {"delta": "..."}    — one per streamed chunk of the reply
+          {"sources": [...]}  — once, after the reply is complete
+        """
+        history = history or []
+
+        docs = await self._aretrieve(user_message)
+        if not docs:
+            yield {"delta": NO_CONTEXT_REPLY}
+            yield {"sources": []}
+            return
+
+        messages, used_docs = self._build_messages(user_message, docs, history)
+
+        async for chunk in self.llm.astream(messages):
+            if chunk.content:
+                yield {"delta": chunk.content}
+
+        yield {"sources": self._extract_sources(used_docs)}